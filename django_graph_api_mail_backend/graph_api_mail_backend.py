@@ -1,25 +1,184 @@
+import os
 import base64
+import hashlib
 import logging
-import collections
+import threading
+import time
 from typing import Callable
+from functools import lru_cache, partial
+from dataclasses import dataclass, field
+from email.utils import parseaddr
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from django.conf import settings
-from requests import Session, RequestException
+from requests import Session, RequestException, Response
+from requests.exceptions import JSONDecodeError
+from urllib3.util import Retry
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from django.core.mail.message import EmailMessage
 from django.core.mail.backends.base import BaseEmailBackend
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 LOGGER = logging.getLogger('django_graph_api_mail')
 
+# don't hand out cached tokens that are about to expire
+TOKEN_CACHE_SAFETY_MARGIN = timedelta(minutes=5)
+# refresh tokens slightly before they expire, so they don't expire mid-request
+TOKEN_EXPIRY_MARGIN = timedelta(seconds=60)
+# fraction of the token's lifetime after which it's refreshed in the background,
+# while emails are still being sent with the current one
+TOKEN_BACKGROUND_REFRESH_AT = 0.8
+
+
 # https://learn.microsoft.com/en-us/graph/auth-v2-user?tabs=http#token-response
-GraphAPIAccessToken = collections.namedtuple('GraphAPIAccessToken', ['value', 'expires_in_seconds', 'refresh_token', 'access_timestamp'])
+@dataclass(slots=True)
+class GraphAPIAccessToken:
+    value: str
+    expires_in_seconds: int
+    refresh_token: str
+    access_timestamp: datetime
+    # computed once per token instead of once per sent email
+    expiry_deadline: datetime = field(init=False)
+    background_refresh_deadline: datetime = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.expiry_deadline = (
+            self.access_timestamp
+            + timedelta(seconds=self.expires_in_seconds)
+            - TOKEN_EXPIRY_MARGIN
+        )
+        self.background_refresh_deadline = self.access_timestamp + timedelta(
+            seconds=self.expires_in_seconds * TOKEN_BACKGROUND_REFRESH_AT,
+        )
+
+
+# tokens are valid for about an hour and can be shared by every backend instance
+# authenticating as the same application, so there is no need to acquire one per instance
+_TOKEN_CACHE: dict[tuple[str, str, str], GraphAPIAccessToken] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+# Django creates a backend instance per sent email, reusing sessions
+# keeps their connection pools (and TLS sessions) warm between them
+_SESSION_CACHE: dict[tuple, Session] = {}
+_SESSION_CACHE_LOCK = threading.Lock()
+
+
+def _forget_sessions_after_fork() -> None:
+    global _SESSION_CACHE_LOCK
+    # pooled sockets can't be shared with the parent, e.g. by preforked gunicorn or uwsgi workers
+    _SESSION_CACHE_LOCK = threading.Lock()
+    _SESSION_CACHE.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_sessions_after_fork)
+
+AUTHORITY_URL = 'https://login.microsoftonline.com'
+GRAPH_API_URL = 'https://graph.microsoft.com/v1.0'
+# https://learn.microsoft.com/en-us/graph/json-batching
+BATCH_ENDPOINT = f'{GRAPH_API_URL}/$batch'
+MAX_BATCH_SIZE = 20
+# https://learn.microsoft.com/en-us/graph/throttling#best-practices-to-handle-throttling
+TOKEN_RETRIED_STATUSES = frozenset([429, 500, 502, 503, 504])
+# sendMail isn't idempotent, a request that timed out or failed with a server error
+# may have been delivered already, so only throttled requests are sent again
+THROTTLED_STATUSES = frozenset([429, 503])
+RETRY_BACKOFF_MAX = 30
+# more concurrent requests to the same mailbox are throttled, even within one batch
+# https://learn.microsoft.com/en-us/graph/throttling-limits#outlook-service-limits
+MAILBOX_CONCURRENCY = 4
+
+
+class Base64Body:
+    """
+    Iterable request body, base64 encoding the wrapped bytes chunk by chunk
+    while they're being sent, so the message is never held in memory twice.
+    Can be iterated many times, so the request can be retried.
+    """
+    # a multiple of 3, so the encoded chunks concatenate without padding in between
+    CHUNK_SIZE = 57 * 1024
+
+    def __init__(self, raw: bytes) -> None:
+        self._raw = memoryview(raw)
 
+    def __len__(self) -> int:
+        # lets requests send a Content-Length instead of using chunked transfer encoding
+        return -(-len(self._raw) // 3) * 4
 
-def construct_token_endpoint(tenant_id: str):
-    return f'https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token'
+    def __iter__(self):
+        for i in range(0, len(self._raw), self.CHUNK_SIZE):
+            yield base64.b64encode(self._raw[i:i + self.CHUNK_SIZE])
 
-def construct_send_email_endpoint(from_email: str):
-    return f'https://graph.microsoft.com/v1.0/users/{from_email}/sendMail'
+
+# deployments use a handful of tenants and senders, so the URLs are built once each
+@lru_cache(maxsize=8)
+def construct_token_endpoint(tenant_id: str) -> str:
+    return f'{AUTHORITY_URL}/{tenant_id}/oauth2/v2.0/token'
+
+@lru_cache(maxsize=256)
+def construct_send_email_path(from_email: str, save_to_sent_items: bool = True) -> str:
+    # https://learn.microsoft.com/en-us/graph/api/user-sendmail?view=graph-rest-1.0&tabs=http#request-body
+    if save_to_sent_items:
+        return f'/users/{from_email}/sendMail'
+    return f'/users/{from_email}/sendMail?saveToSentItems=false'
+
+@lru_cache(maxsize=256)
+def construct_send_email_endpoint(from_email: str, save_to_sent_items: bool = True) -> str:
+    return f'{GRAPH_API_URL}{construct_send_email_path(from_email, save_to_sent_items)}'
+
+
+def parse_json(response: Response) -> dict:
+    try:
+        return json_loads(response.content)
+    except ValueError as e:
+        # like response.json(), so a response that isn't JSON (e.g. a proxy's error page)
+        # is handled like any other failed request
+        raise JSONDecodeError(str(e), response.text, 0, response=response) from e
+
+
+class SerializedMessages:
+    """
+    Serializes the messages of one send_messages call. A message object that is sent
+    more than once is serialized only once, and kept only until its last send,
+    so its copies share the Date and Message-ID headers.
+    """
+    def __init__(self, email_messages: list[EmailMessage]) -> None:
+        self._remaining_sends = {
+            key: count
+            for key, count in Counter(map(id, email_messages)).items()
+            if count > 1
+        }
+        self._serialized: dict[int, bytes] = {}
+        # batches are serialized from many threads at once
+        self._lock = threading.Lock()
+
+    def serialize(self, email_message: EmailMessage) -> bytes:
+        key = id(email_message)
+        with self._lock:
+            remaining_sends = self._remaining_sends.get(key)
+            if remaining_sends is None:
+                serialized = None
+            else:
+                serialized = self._serialized.get(key)
+                if serialized is None:
+                    serialized = self._serialized[key] = _serialize(email_message)
+                if remaining_sends > 1:
+                    self._remaining_sends[key] = remaining_sends - 1
+                else:
+                    del self._remaining_sends[key]
+                    del self._serialized[key]
+        # most messages are sent once, there's nothing to keep for them
+        return _serialize(email_message) if serialized is None else serialized
+
+
+def _serialize(email_message: EmailMessage) -> bytes:
+    return email_message.message().as_bytes(linesep='\r\n')
 
 
 # https://learn.microsoft.com/en-us/graph/api/user-sendmail
@@ -33,28 +192,91 @@ class GraphAPIMailBackend(BaseEmailBackend):
         fail_silently: bool = False,
         authority: str = None,
         timeout: float = 5,
+        concurrency: int = 16,
+        pool_size: int | None = None,
+        max_retries: int = 3,
+        batch_size: int = MAX_BATCH_SIZE,
+        save_to_sent_items: bool = True,
         get_now: Callable[[], datetime] = datetime.now,
+        sleep: Callable[[float], None] = time.sleep,
         create_session: Callable[[], Session] = Session,
     ) -> None:
         super().__init__(fail_silently=fail_silently)
         self._client_id = client_id or settings.ADFS_CLIENT_ID
         self._client_secret = client_secret or settings.ADFS_CLIENT_SECRET
-        self._authority = construct_token_endpoint(tenant_id or settings.ADFS_TENANT_ID)
+        tenant_id = tenant_id or settings.ADFS_TENANT_ID
+        self._authority = construct_token_endpoint(tenant_id)
+        self._token_cache_key = (
+            self._client_id,
+            tenant_id,
+            hashlib.sha256(self._client_secret.encode()).hexdigest(),
+        )
         self._access_token: GraphAPIAccessToken | None = None 
+        self._refresh_executor: ThreadPoolExecutor | None = None
+        self._pending_refresh: Future[GraphAPIAccessToken] | None = None
         self._http_session: Session | None = None
         self._create_session = create_session
         self._get_now = get_now
+        self._sleep = sleep
+        # guards the session and the token, so one instance can be shared between threads
+        self._lock = threading.RLock()
+        # how many send_messages calls are using the connection
+        self._sends_in_flight = 0
+        # whether the connection is closed once the last send_messages call finishes
+        self._close_after_sends = False
         try:
             self._timeout = settings.GRAPH_MAIL_BACKEND_TIMEOUT
         except AttributeError:
             self._timeout = timeout
+        try:
+            self._concurrency = settings.GRAPH_MAIL_BACKEND_CONCURRENCY
+        except AttributeError:
+            self._concurrency = concurrency
+        try:
+            self._pool_size = settings.GRAPH_MAIL_BACKEND_POOL_SIZE
+        except AttributeError:
+            self._pool_size = pool_size or max(10, self._concurrency)
+        try:
+            self._max_retries = settings.GRAPH_MAIL_BACKEND_MAX_RETRIES
+        except AttributeError:
+            self._max_retries = max_retries
+        try:
+            batch_size = settings.GRAPH_MAIL_BACKEND_BATCH_SIZE
+        except AttributeError:
+            pass
+        self._batch_size = min(batch_size, MAX_BATCH_SIZE)
+        try:
+            self._save_to_sent_items = settings.GRAPH_MAIL_BACKEND_SAVE_TO_SENT_ITEMS
+        except AttributeError:
+            self._save_to_sent_items = save_to_sent_items
+        self._session_cache_key = (
+            self._create_session,
+            *self._token_cache_key,
+            self._timeout,
+            self._pool_size,
+            self._max_retries,
+        )
 
     def open(self) -> bool:
-        if self._http_session is not None:
-            return False
-        self._http_session = self._create_session() 
+        return bool(self._open(sending=False))
+
+    # returns whether a new connection was opened, or None when it failed silently,
+    # a send is counted as in flight, so the connection isn't closed under it
+    def _open(self, sending: bool) -> bool | None:
+        with self._lock:
+            if self._http_session is not None:
+                return self._reuse_connection(sending)
+            with _SESSION_CACHE_LOCK:
+                http_session = _SESSION_CACHE.get(self._session_cache_key)
+                if http_session is None:
+                    http_session = self._create_pooled_session()
+                    _SESSION_CACHE[self._session_cache_key] = http_session
+        # without holding the lock, so threads sharing the backend aren't blocked behind the authority
         try:
-            self._access_token = self._retrive_access_token()
+            access_token = self._get_cached_access_token()
+            if access_token is None:
+                access_token = self._retrive_access_token(http_session)
+                self._cache_access_token(access_token)
         except RequestException as e:
             try:
                 LOGGER.error(
@@ -73,16 +295,136 @@ class GraphAPIMailBackend(BaseEmailBackend):
 
             if not self.fail_silently:
                 raise
+            return None
+        with self._lock:
+            if self._http_session is not None:
+                # opened by another thread in the meantime
+                return self._reuse_connection(sending)
+            self._http_session = http_session
+            self._access_token = access_token
+            if sending:
+                self._sends_in_flight += 1
+                self._close_after_sends = True
+            return True
+
+    def _reuse_connection(self, sending: bool) -> bool:
+        if sending:
+            self._sends_in_flight += 1
             return False
-        self._http_session.headers = {
-            'Content-Type': 'text/plain',
+        # the connection was to be closed once the sends in flight finish,
+        # now it's the caller's to close
+        if self._close_after_sends:
+            self._close_after_sends = False
+            return True
+        return False
+
+    def _create_pooled_session(self) -> Session:
+        session = self._create_session()
+        # keep connections to Graph alive for the whole batch, blocking
+        # instead of opening throwaway connections when the pool is exhausted
+        session.mount('https://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self._pool_size,
+            pool_block=True,
+            max_retries=self._create_retry(
+                status_forcelist=THROTTLED_STATUSES,
+                # neither are connection errors after the request was sent
+                read=0,
+                other=0,
+            ),
+        ))
+        # token requests can be repeated safely
+        session.mount(f'{AUTHORITY_URL}/', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=self._create_retry(status_forcelist=TOKEN_RETRIED_STATUSES),
+        ))
+        return session
+
+    def _create_retry(self, status_forcelist: frozenset[int], **kwargs) -> Retry:
+        # https://learn.microsoft.com/en-us/graph/throttling#best-practices-to-handle-throttling
+        return Retry(
+            total=self._max_retries,
+            backoff_factor=1.0,
+            backoff_max=RETRY_BACKOFF_MAX,
+            backoff_jitter=0.5,
+            status_forcelist=status_forcelist,
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+            # hand back the last response instead of raising, once out of retries
+            raise_on_status=False,
+            **kwargs,
+        )
+
+    def _use_refreshed_access_token(self, token: GraphAPIAccessToken) -> None:
+        self._access_token = token
+        self._cache_access_token(token)
+
+    def _graph_headers(self, content_type: str) -> dict[str, str]:
+        # passed with every request, the session is shared with other backend instances
+        # and its headers would be sent to the authority as well
+        return {
+            'Content-Type': content_type,
             'Authorization': f'Bearer {self._access_token.value}',
         }
-        return True
 
-    def _retrive_access_token(self) -> GraphAPIAccessToken | None:
+    def _ensure_fresh_access_token(self) -> None:
+        with self._lock:
+            if self._pending_refresh is not None and self._pending_refresh.done():
+                pending_refresh, self._pending_refresh = self._pending_refresh, None
+                try:
+                    self._use_refreshed_access_token(pending_refresh.result())
+                except RequestException as e:
+                    # the current token is still valid, the refresh is reattempted later
+                    LOGGER.warning(
+                        'Cannot refresh ADFS access token in the background',
+                        exc_info=e,
+                    )
+            now = self._get_now()
+            if self._access_token.background_refresh_deadline > now:
+                return
+            if self._pending_refresh is None:
+                if self._refresh_executor is None:
+                    self._refresh_executor = ThreadPoolExecutor(max_workers=1)
+                self._pending_refresh = self._refresh_executor.submit(
+                    self._refresh_access_token,
+                    self._http_session,
+                    self._access_token.refresh_token,
+                )
+            if self._access_token.expiry_deadline > now:
+                # emails are still sent with the current token, while it's refreshed in the background
+                return
+            pending_refresh = self._pending_refresh
+        # waited for without holding the lock, every thread needing a token waits for the same refresh
+        try:
+            access_token = pending_refresh.result()
+        except RequestException:
+            with self._lock:
+                if self._pending_refresh is pending_refresh:
+                    self._pending_refresh = None
+            raise
+        with self._lock:
+            if self._pending_refresh is pending_refresh:
+                self._pending_refresh = None
+                self._use_refreshed_access_token(access_token)
+
+    def _get_cached_access_token(self) -> GraphAPIAccessToken | None:
+        with _TOKEN_CACHE_LOCK:
+            token = _TOKEN_CACHE.get(self._token_cache_key)
+        if token is None:
+            return None
+        expires_at = token.access_timestamp + timedelta(seconds=token.expires_in_seconds)
+        if expires_at - TOKEN_CACHE_SAFETY_MARGIN <= self._get_now():
+            return None
+        return token
+
+    def _cache_access_token(self, token: GraphAPIAccessToken) -> None:
+        with _TOKEN_CACHE_LOCK:
+            _TOKEN_CACHE[self._token_cache_key] = token
+
+    def _retrive_access_token(self, http_session: Session) -> GraphAPIAccessToken:
         # https://learn.microsoft.com/en-us/graph/auth-v2-user?tabs=http#token-request
-        response = self._http_session.post(
+        response = http_session.post(
             url=self._authority,
             data={
                 'client_id': self._client_id,
@@ -93,7 +435,7 @@ class GraphAPIMailBackend(BaseEmailBackend):
             timeout=self._timeout,
         )
         response.raise_for_status()
-        response = response.json()
+        response = parse_json(response)
 
         # https://learn.microsoft.com/en-us/graph/auth-v2-user?tabs=http#token-response
         return GraphAPIAccessToken(
@@ -103,20 +445,24 @@ class GraphAPIMailBackend(BaseEmailBackend):
             access_timestamp=self._get_now(),
         )
 
-    def _refresh_access_token(self) -> GraphAPIAccessToken:
+    def _refresh_access_token(
+        self,
+        http_session: Session,
+        refresh_token: str,
+    ) -> GraphAPIAccessToken:
         # https://learn.microsoft.com/en-us/graph/auth-v2-user?tabs=http#request-1
-        response = self._http_session.post(
+        response = http_session.post(
             url=self._authority,
             data={
                 'grant_type': 'refresh_token',
                 'client_id': self._client_id,
                 'client_secret': self._client_secret,
-                'refresh_token': self._access_token.refresh_token ,
+                'refresh_token': refresh_token,
             },
             timeout=self._timeout,
         )
         response.raise_for_status()
-        response = response.json()
+        response = parse_json(response)
 
         # https://learn.microsoft.com/en-us/graph/auth-v2-user?tabs=http#response-1
         return GraphAPIAccessToken(
@@ -127,57 +473,106 @@ class GraphAPIMailBackend(BaseEmailBackend):
         )
 
     def close(self) -> None:
-        self._http_session.close()
+        with self._lock:
+            if self._http_session is None:
+                return
+            # other threads are still sending through the connection, the last one closes it
+            if self._sends_in_flight > 0:
+                self._close_after_sends = True
+                return
+            refresh_executor, pending_refresh = self._detach()
+        self._stop_refreshing(refresh_executor, pending_refresh)
+
+    def _detach(self) -> tuple[ThreadPoolExecutor | None, Future[GraphAPIAccessToken] | None]:
+        self._close_after_sends = False
+        refresh_executor, self._refresh_executor = self._refresh_executor, None
+        pending_refresh, self._pending_refresh = self._pending_refresh, None
+        # the session isn't closed, but left in _SESSION_CACHE for other backend instances
+        self._http_session = None
+        return refresh_executor, pending_refresh
+
+    def _stop_refreshing(
+        self,
+        refresh_executor: ThreadPoolExecutor | None,
+        pending_refresh: Future[GraphAPIAccessToken] | None,
+    ) -> None:
+        if refresh_executor is None:
+            return
+        # waited for without holding the lock, the backend can be opened again in the meantime
+        refresh_executor.shutdown()
+        # keep the refreshed token, or the next send_messages refreshes it all over again
+        if pending_refresh is not None and pending_refresh.exception() is None:
+            self._cache_access_token(pending_refresh.result())
 
     def send_messages(
         self,
         email_messages: list[EmailMessage],
     ) -> int:
-        failed_silently = not self.open() and self._access_token is None
-        if failed_silently:
-            return 0 
-        sent_count = 0
+        if self._open(sending=True) is None:
+            # failed silently
+            return 0
+        try:
+            return self._send_messages(email_messages)
+        finally:
+            detached = None
+            with self._lock:
+                self._sends_in_flight -= 1
+                if self._sends_in_flight == 0 and self._close_after_sends:
+                    detached = self._detach()
+            if detached is not None:
+                self._stop_refreshing(*detached)
+
+    def _send_messages(self, email_messages: list[EmailMessage]) -> int:
+        to_send = []
         for email_message in email_messages:
-            if not email_message.recipients():
+            # same as email_message.recipients(), without building the list
+            if not (email_message.to or email_message.cc or email_message.bcc):
                 LOGGER.warning(
                     'Email titled [%s] was without any recipients',
                     email_message.subject,
                 )
                 continue
-            email_message.from_email = email_message.from_email.split('<')[-1].split('>')[0]
-            try:
-                if self._access_token.access_timestamp + timedelta(seconds=self._access_token.expires_in_seconds) <= self._get_now():
-                    self._access_token = self._refresh_access_token()
-                response = self._http_session.post(
-                    url=construct_send_email_endpoint(email_message.from_email),
-                    data=base64.b64encode(
-                        email_message.message().as_bytes(linesep='\r\n')
-                    ),
-                    timeout=self._timeout,
-                )
-                if response.ok:
-                    sent_count += 1
-            except RequestException as e:
-                try:
-                    LOGGER.error(
-                        'Failed to send email with subject: [%s]. Authority saying: %s (%s)'
-                        'Response body: %s',
-                        email_message.subject,
-                        e.response.reason,
-                        e.response.status_code,
-                        e.response.text,
-                        exc_info=e,
-                    )
-                except AttributeError:
-                    LOGGER.error(
-                        'Failed to send email with subject: [%s]',
-                        email_message.subject,
-                        exc_info=e,
-                    )
-
-                if self.fail_silently:
-                    continue
-                raise
+            # most senders are bare addresses, with nothing to parse
+            if '<' in email_message.from_email:
+                _, from_email = parseaddr(email_message.from_email)
+                email_message.from_email = from_email or email_message.from_email
+            to_send.append(email_message)
+        # Graph throttles more than MAILBOX_CONCURRENCY concurrent requests to one mailbox,
+        # so every sender's emails are sent in rounds, while emails of different senders share them
+        emails_by_sender: dict[str, list[EmailMessage]] = {}
+        for email_message in to_send:
+            emails_by_sender.setdefault(email_message.from_email, []).append(email_message)
+        most_emails = max(map(len, emails_by_sender.values()), default=0)
+        rounds = [
+            [
+                email_message
+                for emails in emails_by_sender.values()
+                for email_message in emails[i:i + MAILBOX_CONCURRENCY]
+            ]
+            for i in range(0, most_emails, MAILBOX_CONCURRENCY)
+        ]
+        # the same message object may be in the list many times,
+        # there's no need to serialize it more than once
+        send_batch = partial(self._send_batch, serialized_messages=SerializedMessages(to_send))
+        sent_count = 0
+        executor = None
+        try:
+            for round_emails in rounds:
+                batches = [
+                    round_emails[i:i + self._batch_size]
+                    for i in range(0, len(round_emails), self._batch_size)
+                ]
+                if self._concurrency > 1 and len(batches) > 1:
+                    # every request is independent and network-bound,
+                    # so there is no reason to wait for one to finish before the next
+                    if executor is None:
+                        executor = ThreadPoolExecutor(max_workers=self._concurrency)
+                    sent_count += sum(executor.map(send_batch, batches))
+                else:
+                    sent_count += sum(map(send_batch, batches))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
         LOGGER.info(
             '%s/%s emails were succesfully sent',
             sent_count,
@@ -185,3 +580,158 @@ class GraphAPIMailBackend(BaseEmailBackend):
         )
         return sent_count
 
+    def _send_batch(
+        self,
+        batch: list[EmailMessage],
+        serialized_messages: SerializedMessages,
+    ) -> int:
+        if len(batch) == 1:
+            return int(self._send_message(batch[0], serialized_messages))
+        # https://learn.microsoft.com/en-us/graph/json-batching#first-json-batch-request
+        pending_requests = [
+            {
+                'id': str(i),
+                'method': 'POST',
+                'url': construct_send_email_path(
+                    email_message.from_email,
+                    self._save_to_sent_items,
+                ),
+                'headers': {'Content-Type': 'text/plain'},
+                # a body that isn't JSON is base64 decoded by $batch before it's forwarded:
+                # https://learn.microsoft.com/en-us/graph/json-batching#request-format
+                # while sendMail expects a base64 encoded MIME message:
+                # https://learn.microsoft.com/en-us/graph/api/user-sendmail?view=graph-rest-1.0&tabs=http#request-body
+                # so the message is encoded twice
+                'body': base64.b64encode(base64.b64encode(
+                    serialized_messages.serialize(email_message)
+                )).decode('ascii'),
+            }
+            for i, email_message in enumerate(batch)
+        ]
+        sent_count = 0
+        for attempt in range(self._max_retries + 1):
+            sub_responses = self._post_batch(pending_requests)
+            unanswered_requests = {request['id']: request for request in pending_requests}
+            pending_requests = []
+            retry_after = 0
+            # https://learn.microsoft.com/en-us/graph/json-batching#response-format
+            for sub_response in sub_responses:
+                request = unanswered_requests.pop(sub_response['id'])
+                if sub_response['status'] == 202:
+                    sent_count += 1
+                    continue
+                # $batch itself succeeds even when its requests are throttled,
+                # so they are retried here instead of by the session's adapter
+                if sub_response['status'] in THROTTLED_STATUSES and attempt < self._max_retries:
+                    pending_requests.append(request)
+                    retry_after = max(retry_after, self._get_retry_after(sub_response, attempt))
+                    continue
+                LOGGER.error(
+                    'Failed to send email with subject: [%s]. Graph saying: (%s) %s',
+                    batch[int(sub_response['id'])].subject,
+                    sub_response['status'],
+                    sub_response.get('body'),
+                )
+            # a batch that failed as a whole was logged already
+            if sub_responses:
+                for request_id in unanswered_requests:
+                    LOGGER.error(
+                        'Failed to send email with subject: [%s]. Graph did not respond to it',
+                        batch[int(request_id)].subject,
+                    )
+            if not pending_requests:
+                break
+            self._sleep(retry_after)
+        return sent_count
+
+    def _post_batch(self, requests: list[dict]) -> list[dict]:
+        try:
+            self._ensure_fresh_access_token()
+            response = self._http_session.post(
+                url=BATCH_ENDPOINT,
+                json={'requests': requests},
+                headers=self._graph_headers('application/json'),
+                timeout=self._timeout,
+            )
+            if response.ok:
+                return parse_json(response)['responses']
+        except RequestException as e:
+            try:
+                LOGGER.error(
+                    'Failed to send a batch of %s emails. Authority saying: %s (%s)'
+                    'Response body: %s',
+                    len(requests),
+                    e.response.reason,
+                    e.response.status_code,
+                    e.response.text,
+                    exc_info=e,
+                )
+            except AttributeError:
+                LOGGER.error(
+                    'Failed to send a batch of %s emails',
+                    len(requests),
+                    exc_info=e,
+                )
+
+            if self.fail_silently:
+                return []
+            raise
+        LOGGER.error(
+            'Failed to send a batch of %s emails. Graph saying: %s (%s)'
+            'Response body: %s',
+            len(requests),
+            response.reason,
+            response.status_code,
+            response.text,
+        )
+        return []
+
+    def _get_retry_after(self, sub_response: dict, attempt: int) -> float:
+        headers = CaseInsensitiveDict(sub_response.get('headers') or {})
+        try:
+            return min(float(headers['Retry-After']), RETRY_BACKOFF_MAX)
+        except (KeyError, ValueError):
+            # the same backoff the session's adapter uses
+            return min(2 ** attempt, RETRY_BACKOFF_MAX)
+
+    def _send_message(
+        self,
+        email_message: EmailMessage,
+        serialized_messages: SerializedMessages,
+    ) -> bool:
+        try:
+            self._ensure_fresh_access_token()
+            response = self._http_session.post(
+                url=construct_send_email_endpoint(
+                    email_message.from_email,
+                    self._save_to_sent_items,
+                ),
+                data=Base64Body(
+                    serialized_messages.serialize(email_message)
+                ),
+                headers=self._graph_headers('text/plain'),
+                timeout=self._timeout,
+            )
+            # https://learn.microsoft.com/en-us/graph/api/user-sendmail?view=graph-rest-1.0&tabs=http#response
+            return response.status_code == 202
+        except RequestException as e:
+            try:
+                LOGGER.error(
+                    'Failed to send email with subject: [%s]. Authority saying: %s (%s)'
+                    'Response body: %s',
+                    email_message.subject,
+                    e.response.reason,
+                    e.response.status_code,
+                    e.response.text,
+                    exc_info=e,
+                )
+            except AttributeError:
+                LOGGER.error(
+                    'Failed to send email with subject: [%s]',
+                    email_message.subject,
+                    exc_info=e,
+                )
+
+            if self.fail_silently:
+                return False
+            raise
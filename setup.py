@@ -15,8 +15,16 @@ setup(
     url='https://github.com/jacadzaca/django_graph_api_mail_backend',
     install_requires=[
         'requests',
+        'urllib3>=2',
         'Django',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'test': [
+            'pytest',
+            'pytest-xdist',
+        ],
+    },
     license='BSD-3-Clause',
     packages=find_packages(
         exclude=(
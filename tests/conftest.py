@@ -1,15 +1,30 @@
-import collections
-from typing import Any
+import copy
+import base64
+import json
+import threading
+import dataclasses
+from typing import Any, Callable
+from dataclasses import dataclass, field
 
 import pytest
 from django.conf import settings
 from requests import RequestException, HTTPError
+from requests.structures import CaseInsensitiveDict
 from django.core.mail.message import EmailMessage
 
 import django_graph_api_mail_backend.graph_api_mail_backend as graph_api_mail_backend
 
-# needed in order to insttiate EmailMessage objects
-settings.configure(DEFAULT_CHARSET='utf-8')
+# needed in order to insttiate EmailMessage objects,
+# configured only once even if conftest gets imported again
+if not settings.configured:
+    settings.configure(DEFAULT_CHARSET='utf-8')
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    graph_api_mail_backend._TOKEN_CACHE.clear()
+    graph_api_mail_backend._SESSION_CACHE.clear()
 
 
 class MockResponse:
@@ -23,10 +38,14 @@ class MockResponse:
     ):
         self.ok = is_ok
         self.response = response
-        self.content = content
+        self.content = content if response is None else json.dumps(response).encode()
         self.reason = reason
         self.status_code = status_code
 
+    @property
+    def text(self):
+        return self.content.decode() if isinstance(self.content, bytes) else self.content
+
     def raise_for_status(self):
         if not self.ok:
             raise HTTPError('some error occurred')
@@ -35,46 +54,86 @@ class MockResponse:
         return self.response
 
 
+def _default_allowed_from_mails() -> set[str]:
+    return {
+        graph_api_mail_backend.construct_send_email_endpoint('from_me@example.com'),
+    }
+
+
+@dataclass(slots=True, eq=False)
 class MockSession:
-    def __init__(
-        self,
-        fail_token_access=False,
-        fail_token_refresh=False,
-        max_email_sents=None,
-        expires_in_seconds=3736,
-        access_token='abcd123',
-        refresh_token='refresh-abcd123',
-        tenant_id='abcd-efgh-hijk',
-        client_id='123-456-789',
-        client_secret='asdf123',
-        raise_request_exception_on_post=False,
-        raise_request_exception_on_sent_mail=False,
-        raise_request_exception_on_refresh_token=False,
-        allowed_from_mails=None
-    ):
-        self.tenant_id = tenant_id
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.access_token = access_token
-        self.refresh_token = refresh_token
-        self.max_email_sents = max_email_sents
-        self.fail_token_access= fail_token_access
-        self.fail_token_refresh = fail_token_refresh
-        self.expires_in_seconds = expires_in_seconds
-        self.raise_request_exception_on_post = raise_request_exception_on_post
-        self.raise_request_exception_on_sent_mail = raise_request_exception_on_sent_mail
-        self.times_token_refreshed = 0
-        self.post_call_count = 0
-        self.sent_emails = 0
-        self.allowed_from_mails = allowed_from_mails or {
-            graph_api_mail_backend.construct_send_email_endpoint('from_me@example.com'),
+    fail_token_access: bool = False
+    fail_token_refresh: bool = False
+    max_email_sents: int | None = None
+    expires_in_seconds: int = 3736
+    access_token: str = 'abcd123'
+    refresh_token: str = 'refresh-abcd123'
+    tenant_id: str = 'abcd-efgh-hijk'
+    client_id: str = '123-456-789'
+    client_secret: str = 'asdf123'
+    raise_request_exception_on_post: bool = False
+    raise_request_exception_on_sent_mail: bool = False
+    raise_request_exception_on_refresh_token: bool = False
+    # how many of the following batched requests fail, and with which status
+    failed_batch_requests: int = 0
+    failed_batch_request_status: int = 429
+    retry_after_seconds: int = 7
+    # how many of the following batched requests are left out of the batch's response
+    unanswered_batch_requests: int = 0
+    fail_batch: bool = False
+    # answer with an HTML page, like a proxy in front of the service could
+    non_json_token_response: bool = False
+    non_json_batch_response: bool = False
+    allowed_from_mails: set[str] = field(default_factory=_default_allowed_from_mails)
+    # called with the url before every request, e.g. to act while the request is in flight
+    on_post: Callable[[str], None] | None = None
+    times_token_refreshed: int = field(default=0, init=False)
+    post_call_count: int = field(default=0, init=False)
+    sent_emails: int = field(default=0, init=False)
+    # every email the backend tried to send, whether it got sent or not
+    attempted_messages: list = field(default_factory=list, init=False)
+    adapters: dict = field(default_factory=dict, init=False)
+    headers: CaseInsensitiveDict = field(
+        default_factory=lambda: CaseInsensitiveDict({'User-Agent': 'python-requests'}),
+        init=False,
+    )
+    # the backend posts from many threads at once
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    @property
+    def credentials(self):
+        return {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'tenant_id': self.tenant_id,
         }
 
-    def post(self, url, data, *_, **__):
+    def close(self):
+        pass
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+    def post(self, url, *args, **kwargs):
+        if self.on_post is not None:
+            self.on_post(url)
+        with self._lock:
+            return self._post(url, *args, **kwargs)
+
+    def _post(self, url, data=None, json=None, headers=None, **__):
         self.post_call_count += 1
         if self.raise_request_exception_on_post:
             raise RequestException('some error occurred')
         if url == graph_api_mail_backend.construct_token_endpoint(self.tenant_id):
+            # requests doesn't set the form's Content-Type when the session already has one
+            if 'Content-Type' in self.headers:
+                return MockResponse(
+                    is_ok=False,
+                    reason='Bad Request',
+                    status_code=400,
+                )
+            if self.non_json_token_response:
+                return MockResponse(content=b'<html>Bad Gateway</html>')
             # https://learn.microsoft.com/en-us/graph/auth-v2-user?tabs=http#token-response
             if data['grant_type'] == 'client_credentials':
                 if self.fail_token_access:
@@ -106,26 +165,122 @@ class MockSession:
                 )
             else:
                 raise ValueError(f'improper grant_type in request to {url} with payload {data}')
-        # https://learn.microsoft.com/en-us/graph/api/user-sendmail?view=graph-rest-1.0&tabs=http#response
-        elif url in self.allowed_from_mails:
+        elif not self._is_authorized(headers):
+            return MockResponse(
+                is_ok=False,
+                reason='Unauthorized',
+                status_code=401,
+            )
+        # https://learn.microsoft.com/en-us/graph/json-batching#response-format
+        elif url == graph_api_mail_backend.BATCH_ENDPOINT:
+            # non-JSON bodies are base64 decoded before they're forwarded
+            self.attempted_messages.extend(
+                base64.b64decode(request['body'], validate=True)
+                for request in json['requests']
+            )
             if self.raise_request_exception_on_sent_mail:
                 raise RequestException('some error occurred')
-            if self.max_email_sents is not None and self.sent_emails >= self.max_email_sents:
+            if self.non_json_batch_response:
+                return MockResponse(content=b'<html>Bad Gateway</html>')
+            if self.fail_batch:
                 return MockResponse(
+                    content='{"error": {"code": "InvalidAuthenticationToken"}}',
                     is_ok=False,
-                    status_code=500,
+                    reason='Unauthorized',
+                    status_code=401,
                 )
-            self.sent_emails += 1
+            responses = []
+            for request in json['requests']:
+                if self.unanswered_batch_requests > 0:
+                    self.unanswered_batch_requests -= 1
+                    continue
+                if self.failed_batch_requests > 0:
+                    self.failed_batch_requests -= 1
+                    responses.append({
+                        'id': request['id'],
+                        'status': self.failed_batch_request_status,
+                        'headers': {'Retry-After': str(self.retry_after_seconds)},
+                    })
+                    continue
+                response = self._send_email(graph_api_mail_backend.GRAPH_API_URL + request['url'])
+                responses.append({
+                    'id': request['id'],
+                    'status': response.status_code,
+                })
             return MockResponse(
-                is_ok=True,
-                status_code=202,
+                response={'responses': responses},
             )
+        # https://learn.microsoft.com/en-us/graph/api/user-sendmail?view=graph-rest-1.0&tabs=http#response
+        elif url in self.allowed_from_mails:
+            self.attempted_messages.append(b''.join(data))
+            if self.raise_request_exception_on_sent_mail:
+                raise RequestException('some error occurred')
+            return self._send_email(url)
         else:
             raise ValueError(f'{url} is not recognized!')
 
+    def _is_authorized(self, headers):
+        # like requests, merging the session's headers with the request's
+        authorization = (headers or {}).get('Authorization') or self.headers.get('Authorization')
+        return authorization == f'Bearer {self.access_token}'
 
+    def _send_email(self, url):
+        if url not in self.allowed_from_mails:
+            raise ValueError(f'{url} is not recognized!')
+        if self.max_email_sents is not None and self.sent_emails >= self.max_email_sents:
+            return MockResponse(
+                is_ok=False,
+                status_code=500,
+            )
+        self.sent_emails += 1
+        return MockResponse(
+            is_ok=True,
+            status_code=202,
+        )
+
+
+# configured by indirect parametrization, e.g.
+# @pytest.mark.parametrize('mock_http_session', [{'fail_token_access': True}], indirect=True)
+@pytest.fixture
+def mock_http_session(request: pytest.FixtureRequest) -> MockSession:
+    return MockSession(**getattr(request, 'param', {}))
+
+
+# the prototype of fresh_happy_session, never handed to tests, as they modify their sessions
+@pytest.fixture(scope='module')
+def _happy_mock_session_proto() -> MockSession:
+    return MockSession()
+
+
+# a clone of the prototype, for tests that need a MockSession working without any failures;
+# every field is copied (and init=False ones rebuilt), so no container is shared between tests
+@pytest.fixture
+def fresh_happy_session(_happy_mock_session_proto: MockSession) -> MockSession:
+    return dataclasses.replace(_happy_mock_session_proto, **{
+        proto_field.name: copy.copy(getattr(_happy_mock_session_proto, proto_field.name))
+        for proto_field in dataclasses.fields(_happy_mock_session_proto)
+        if proto_field.init
+    })
+
+
+MakeBackend = Callable[..., graph_api_mail_backend.GraphAPIMailBackend]
+
+
+# constructs a backend authenticating with, and sending through, mock_http_session
 @pytest.fixture
-def example_message():
+def make_backend() -> MakeBackend:
+    def make(mock_http_session: MockSession, **kwargs) -> graph_api_mail_backend.GraphAPIMailBackend:
+        return graph_api_mail_backend.GraphAPIMailBackend(
+            **mock_http_session.credentials,
+            create_session=lambda: mock_http_session,
+            **kwargs,
+        )
+    return make
+
+
+# shared by the whole session, must not be modified by tests
+@pytest.fixture(scope='session')
+def example_message_ro():
     return EmailMessage(
         subject='Some email subject',
         body="Some email body",
@@ -136,3 +291,27 @@ def example_message():
         reply_to=['replayto1@example.com', 'replayto2@example.com'],
     )
 
+
+# a copy of example_message_ro, for tests that modify the message
+@pytest.fixture
+def example_message(example_message_ro: EmailMessage):
+    return copy.deepcopy(example_message_ro)
+
+
+MakeEmail = Callable[..., EmailMessage]
+
+
+# constructs a message like example_message_ro, with the given fields overridden
+@pytest.fixture
+def make_email() -> MakeEmail:
+    def make(**overrides) -> EmailMessage:
+        return EmailMessage(**{
+            'subject': 'Some email subject',
+            'body': 'Some email body',
+            'from_email': 'from_me@example.com',
+            'to': ['recipient1@example.com'],
+            'cc': [],
+            'bcc': [],
+            **overrides,
+        })
+    return make
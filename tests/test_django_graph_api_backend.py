@@ -1,254 +1,885 @@
+import email
+import base64
+import itertools
+import threading
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from requests import RequestException, HTTPError
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
 from django.core.mail.message import EmailMessage
 
-from tests.conftest import MockResponse, MockSession
-from django_graph_api_mail_backend.graph_api_mail_backend import GraphAPIMailBackend
+from tests.conftest import MakeBackend, MakeEmail, MockResponse, MockSession
+import django_graph_api_mail_backend.graph_api_mail_backend as graph_api_mail_backend
+from django_graph_api_mail_backend.graph_api_mail_backend import (
+    Base64Body,
+    GraphAPIMailBackend,
+    SerializedMessages,
+)
 
 
-@pytest.mark.parametrize('missing_field', [
-    'client_id',
-    'client_secret',
-    'tenant_id',
+def test_graph_api_backend_must_be_constructed_with_client_id_client_secret_and_tenant_id():
+    for missing_field in ('client_id', 'client_secret', 'tenant_id'):
+        active_driectory_secrets = {
+            'client_id': '123',
+            'client_secret': 'asdf123',
+            'tenant_id': 'test123',
+        }
+        active_driectory_secrets.pop(missing_field)
+        with pytest.raises(AttributeError):
+            GraphAPIMailBackend(**active_driectory_secrets)
+
+
+@pytest.mark.parametrize('mock_http_session', [{'fail_token_access': True}], indirect=True)
+@pytest.mark.parametrize('fail_silently, expect', [
+    (False, 'raises'),
+    (True, 'returns_false'),
+    (True, 'send_zero'),
+], ids=[
+    'open_raises_http_error_when_fail_silently_off',
+    'open_returns_false_when_fail_silently_on',
+    'send_messages_returns_0_when_fail_silently_on',
 ])
-def test_graph_api_backend_must_be_constructed_with_client_id_client_secret_and_tenant_id(missing_field):
-    active_driectory_secrets = {
-        'client_id': '123',
-        'client_secret': 'asdf123',
-        'tenant_id': 'test123',
-    }
-    active_driectory_secrets.pop(missing_field)
-    with pytest.raises(AttributeError):
-        GraphAPIMailBackend(**active_driectory_secrets)
-
-
-def test_open_raises_http_error_when_retriving_token_fails_and_fails_silently_off():
-    mock_http_session = MockSession(
-        fail_token_access=True,
+def test_retriving_token_fails(
+    fail_silently: bool,
+    expect: str,
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=fail_silently,
     )
-    backend = GraphAPIMailBackend(
+    if expect == 'raises':
+        try:
+            backend.open()
+        except HTTPError:
+            pass
+        else:
+            pytest.fail('expected HTTPError')
+    elif expect == 'returns_false':
+        assert not backend.open()
+    else:
+        sent_emails_count = backend.send_messages([example_message_ro])
+        assert sent_emails_count == 0
+
+
+def test_send_messages_refreshes_token_if_it_has_expired(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    start = datetime(year=2002, month=7, day=22, hour=12, minute=00, second=00)
+    # every call moves the clock by half of the token's lifetime: the token is
+    # acquired at the start, valid for the first email and expired for the second
+    counter = itertools.count()
+    step = timedelta(seconds=mock_http_session.expires_in_seconds // 2)
+    def get_now():
+        return start + next(counter) * step
+
+    backend = make_backend(
+        mock_http_session,
         fail_silently=False,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+        # one request per email, so the token is checked before each of them
+        batch_size=1,
+        get_now=get_now,
     )
-    with pytest.raises(HTTPError):
-        backend.open()
+    backend.send_messages([example_message_ro] * 2)
+    assert mock_http_session.times_token_refreshed == 1
 
 
-def test_open_returns_false_when_retriving_token_fails_and_fail_silently_on():
-    mock_http_session = MockSession(
-        fail_token_access=True,
+@pytest.mark.parametrize('mock_http_session', [{'max_email_sents': 2}], indirect=True)
+def test_send_messages_returns_count_of_succesfuly_sent_emails(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    # the mock fails with a 500, which would otherwise be retried
+    backend = make_backend(mock_http_session, max_retries=0)
+    to_send = [example_message_ro] * 3
+    successfully_sent_count = backend.send_messages(to_send)
+    assert successfully_sent_count == len(to_send) - 1
+
+
+@pytest.mark.parametrize('mock_http_session', [{'fail_token_refresh': True, 'expires_in_seconds': 0}], indirect=True)
+def test_send_messages_raises_http_error_when_refresh_token_fails_and_fails_silently_off(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
     )
-    backend = GraphAPIMailBackend(
+    try:
+        backend.send_messages([example_message_ro])
+    except HTTPError:
+        pass
+    else:
+        pytest.fail('expected HTTPError')
+
+
+@pytest.mark.parametrize('mock_http_session', [{'raise_request_exception_on_post': True}], indirect=True)
+def test_open_swallows_requests_exceptions_when_fail_silently_on(
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    backend = make_backend(
+        mock_http_session,
         fail_silently=True,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
     )
     assert not backend.open()
 
 
-def test_send_messages_returns_0_when_cannot_open_connection_and_fail_silently_on(
-    example_message: EmailMessage,
+@pytest.mark.parametrize('mock_http_session', [{'raise_request_exception_on_sent_mail': True}], indirect=True)
+def test_send_messages_tries_to_send_all_messages_when_fail_silently_on(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=True,
+        batch_size=1,
+    )
+    to_send = [example_message_ro] * 2
+    backend.send_messages(to_send)
+    assert len(mock_http_session.attempted_messages) == len(to_send)
+
+
+@pytest.mark.parametrize('fail_silently, expected_exception, fail_sent_mail, fail_token_refresh', [
+    (True, None, False, True),
+    (True, None, True, False),
+    (False, HTTPError, False, True),
+    (False, RequestException, True, False),
+])
+def test_send_messages_swallows_requests_exceptions_only_when_fail_silently_on(
+    fail_silently: bool,
+    expected_exception: type[Exception] | None,
+    fail_sent_mail: bool,
+    fail_token_refresh: bool,
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
 ):
     mock_http_session = MockSession(
-        fail_token_access=True,
+        raise_request_exception_on_sent_mail=fail_sent_mail,
+        fail_token_refresh=fail_token_refresh,
+        # set so token is refreshed so to test case when refreshing token fails
+        expires_in_seconds=0,
     )
-    backend = GraphAPIMailBackend(
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=fail_silently,
+    )
+    if expected_exception is None:
+        successfully_sent_count = backend.send_messages([example_message_ro])
+        assert successfully_sent_count == 0
+    else:
+        try:
+            backend.send_messages([example_message_ro])
+        except expected_exception:
+            pass
+        else:
+            pytest.fail(f'expected {expected_exception.__name__}')
+
+
+@pytest.mark.parametrize('mock_http_session', [
+    {'non_json_token_response': True},
+    {'non_json_batch_response': True},
+], indirect=True)
+def test_send_messages_returns_0_on_responses_that_arent_json_when_fail_silently_on(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    backend = make_backend(
+        mock_http_session,
         fail_silently=True,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+    )
+    assert backend.send_messages([example_message_ro] * 2) == 0
+
+
+def test_emails_without_recipients_are_not_sent(
+    make_email: MakeEmail,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    example_message = make_email(to=[], cc=[], bcc=[])
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
     )
     sent_emails_count = backend.send_messages([example_message])
     assert sent_emails_count == 0
 
 
-def test_send_messages_refreshes_token_if_it_has_expired(
-    example_message: EmailMessage,
+def test_email_is_extracted_from_from_email_in_name_form(
+    make_email: MakeEmail,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    example_message = make_email(from_email='Fred <from_me@example.com>')
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    backend.send_messages([example_message])
+
+
+def test_open_mounts_connection_pool_large_enough_for_concurrent_sends(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        concurrency=32,
+    )
+    backend.open()
+    adapter = mock_http_session.adapters['https://']
+    # the keyword arguments of every pool the adapter creates
+    assert adapter.poolmanager.connection_pool_kw['maxsize'] == 32
+    assert adapter.poolmanager.connection_pool_kw['block']
+
+
+def test_open_reuses_access_token_acquired_by_another_backend(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
 ):
-    mock_http_session = MockSession()
+    mock_http_session = fresh_happy_session
+    backends = [
+        make_backend(
+            mock_http_session,
+            fail_silently=False,
+        )
+        for _ in range(2)
+    ]
+    for backend in backends:
+        backend.open()
+    assert mock_http_session.post_call_count == 1
+
+
+def test_send_messages_refreshes_token_shortly_before_it_expires(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
     start = datetime(year=2002, month=7, day=22, hour=12, minute=00, second=00)
     time_moments = iter([
         start,
-        start + timedelta(seconds=mock_http_session.expires_in_seconds // 3),
-        start + timedelta(seconds=mock_http_session.expires_in_seconds // 2),
-        # token should be considered expired here
-        start + timedelta(seconds=mock_http_session.expires_in_seconds),
-        # the last one's for _refresh_token to get it's timestmap
-        start + timedelta(seconds=mock_http_session.expires_in_seconds),
+        # within TOKEN_EXPIRY_MARGIN of the expiry
+        start + timedelta(seconds=mock_http_session.expires_in_seconds - 30),
+        start + timedelta(seconds=mock_http_session.expires_in_seconds - 30),
     ])
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        get_now=lambda: next(time_moments),
+    )
+    backend.send_messages([example_message_ro])
+    assert mock_http_session.times_token_refreshed == 1
+
+
+def test_open_mounts_adapter_retrying_throttled_requests(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        max_retries=5,
+    )
+    backend.open()
+    retry = mock_http_session.adapters['https://'].max_retries
+    assert retry.total == 5
+    assert retry.is_retry('POST', 429, has_retry_after=True)
+    assert retry.is_retry('POST', 503, has_retry_after=True)
+
+
+@pytest.mark.parametrize('status_code', [500, 502, 504])
+def test_open_mounts_adapter_not_resending_emails_failed_with_server_error(
+    status_code: int,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    backend.open()
+    retry = mock_http_session.adapters['https://'].max_retries
+    # Graph may have accepted the email anyway
+    assert not retry.is_retry('POST', status_code)
+
+
+def test_open_mounts_adapter_not_resending_emails_after_read_timeout(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    backend.open()
+    retry = mock_http_session.adapters['https://'].max_retries
+    url = graph_api_mail_backend.construct_send_email_endpoint('from_me@example.com')
+    try:
+        retry.increment('POST', url, error=ReadTimeoutError(None, url, 'Read timed out.'))
+    except MaxRetryError:
+        pass
+    else:
+        pytest.fail('expected the read timeout not to be retried')
+
+
+def test_open_mounts_adapter_retrying_token_requests_failed_with_server_error(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    backend.open()
+    retry = mock_http_session.adapters[f'{graph_api_mail_backend.AUTHORITY_URL}/'].max_retries
+    assert retry.is_retry('POST', 500)
+    assert retry.is_retry('POST', 429, has_retry_after=True)
+
+
+@pytest.mark.parametrize('size', [
+    0,
+    1,
+    Base64Body.CHUNK_SIZE,
+    Base64Body.CHUNK_SIZE * 2 + 1,
+])
+def test_base64_body_encodes_the_same_as_b64encode_every_time_its_iterated(size):
+    raw = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+    body = Base64Body(raw)
+    for _ in range(2):
+        encoded = b''.join(body)
+        assert encoded == base64.b64encode(raw)
+        assert len(body) == len(encoded)
+
+
+def test_email_is_extracted_from_from_email_with_quoted_name_containing_brackets(
+    make_email: MakeEmail,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    address = 'from_me@example.com'
+    example_message = make_email(from_email=f'"Fred <fred@example.com>" <{address}>')
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    assert backend.send_messages([example_message]) == 1
+    assert example_message.from_email == address
+
+
+def test_send_messages_refreshes_token_in_the_background_when_it_nears_expiry(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    start = datetime(year=2002, month=7, day=22, hour=12, minute=00, second=00)
+    time_moments = iter([start])
     def get_now():
-        return next(time_moments)
+        # past TOKEN_BACKGROUND_REFRESH_AT of the token's lifetime, but not expired
+        return next(time_moments, start + timedelta(seconds=mock_http_session.expires_in_seconds * 0.9))
 
-    backend = GraphAPIMailBackend(
+    backend = make_backend(
+        mock_http_session,
         fail_silently=False,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
+        concurrency=1,
         get_now=get_now,
-        create_session=lambda: mock_http_session,
     )
-    backend.send_messages([example_message] * 3)
+    # closing the connection at the end waits for the background refresh to finish
+    sent_emails_count = backend.send_messages([example_message_ro] * 3)
+    assert sent_emails_count == 3
     assert mock_http_session.times_token_refreshed == 1
 
 
-def test_send_messages_returns_count_of_succesfuly_sent_emails(
-    example_message: EmailMessage,
+def test_send_messages_caches_token_refreshed_in_the_background(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
 ):
-    mock_http_session = MockSession(
-        max_email_sents=2,
+    mock_http_session = fresh_happy_session
+    start = datetime(year=2002, month=7, day=22, hour=12, minute=00, second=00)
+    refreshed_at = start + timedelta(seconds=mock_http_session.expires_in_seconds * 0.85)
+    time_moments = iter([start])
+    def get_now():
+        return next(time_moments, refreshed_at)
+
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        concurrency=1,
+        get_now=get_now,
     )
-    backend = GraphAPIMailBackend(
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+    for _ in range(5):
+        assert backend.send_messages([example_message_ro]) == 1
+    assert mock_http_session.times_token_refreshed == 1
+    # the first token is about to expire by then, so only the refreshed one can be reused
+    post_call_count = mock_http_session.post_call_count
+    other_backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        get_now=lambda: start + timedelta(seconds=mock_http_session.expires_in_seconds - 120),
     )
-    to_send = [example_message] * 3
-    successfully_sent_count = backend.send_messages(to_send)
-    assert successfully_sent_count == len(to_send) - 1
+    assert other_backend.open()
+    assert mock_http_session.post_call_count == post_call_count
 
 
-def test_send_messages_raises_http_error_when_refresh_token_fails_and_fails_silently_off(
-    example_message: EmailMessage,
+def test_send_messages_sends_each_email_from_its_own_sender(
+    example_message_ro: EmailMessage,
+    make_email: MakeEmail,
+    make_backend: MakeBackend,
 ):
+    other_message = make_email(from_email='Someone Else <from_someone_else@example.com>')
     mock_http_session = MockSession(
-        fail_token_refresh=True,
-        expires_in_seconds=0,
+        allowed_from_mails={
+            graph_api_mail_backend.construct_send_email_endpoint('from_me@example.com'),
+            graph_api_mail_backend.construct_send_email_endpoint('from_someone_else@example.com'),
+        },
     )
-    backend = GraphAPIMailBackend(
+    backend = make_backend(
+        mock_http_session,
         fail_silently=False,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
     )
-    with pytest.raises(HTTPError):
-        backend.send_messages([example_message])
+    sent_emails_count = backend.send_messages([example_message_ro, other_message, example_message_ro])
+    assert sent_emails_count == 3
 
 
-def test_open_swallows_requests_exceptions_when_fail_silently_on():
+@pytest.mark.parametrize('emails_count, expected_requests_count', [
+    (2, 1),
+    (graph_api_mail_backend.MAILBOX_CONCURRENCY, 1),
+    # no more than MAILBOX_CONCURRENCY emails of one sender per batch
+    (graph_api_mail_backend.MAILBOX_CONCURRENCY * 2 + 2, 3),
+])
+def test_send_messages_sends_emails_in_batches(
+    example_message_ro: EmailMessage,
+    emails_count: int,
+    expected_requests_count: int,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    sent_emails_count = backend.send_messages([example_message_ro] * emails_count)
+    assert sent_emails_count == emails_count
+    # the - 1 is there to account for token acqusition request
+    assert (mock_http_session.post_call_count - 1) == expected_requests_count
+
+
+def test_send_messages_sends_emails_of_many_senders_in_one_batch(
+    make_email: MakeEmail,
+    make_backend: MakeBackend,
+):
+    senders = [f'sender{i}@example.com' for i in range(5)]
     mock_http_session = MockSession(
-        raise_request_exception_on_post=True,
+        allowed_from_mails={
+            graph_api_mail_backend.construct_send_email_endpoint(sender)
+            for sender in senders
+        },
     )
-    backend = GraphAPIMailBackend(
-        fail_silently=True,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
     )
-    assert not backend.open()
+    to_send = [
+        make_email(from_email=sender)
+        for sender in senders
+        for _ in range(graph_api_mail_backend.MAILBOX_CONCURRENCY)
+    ]
+    assert backend.send_messages(to_send) == graph_api_mail_backend.MAX_BATCH_SIZE
+    # the - 1 is there to account for token acqusition request
+    assert (mock_http_session.post_call_count - 1) == 1
 
 
-@pytest.mark.parametrize('fail_sent_mail, fail_token_refresh', [
-    (False, True),
-    (True, False),
+@pytest.mark.parametrize('mock_http_session', [
+    {'failed_batch_requests': 2, 'failed_batch_request_status': 429},
+    {'failed_batch_requests': 2, 'failed_batch_request_status': 503},
+], indirect=True)
+@pytest.mark.parametrize('max_retries, expected_sent_count, expected_sleeps', [
+    (3, 3, [7]),
+    (0, 1, []),
 ])
-def test_send_messages_swallows_requests_exceptions_when_fail_silently_on(
-    example_message: EmailMessage,
-    fail_sent_mail: bool,
-    fail_token_refresh: bool,
+def test_send_messages_retries_throttled_batched_requests_after_retry_after(
+    max_retries: int,
+    expected_sent_count: int,
+    expected_sleeps: list[float],
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
 ):
-    mock_http_session = MockSession(
-        raise_request_exception_on_sent_mail=fail_sent_mail,
-        fail_token_refresh=fail_token_refresh,
-        # set so token is refreshed so to test case when refreshing token fails
-        expires_in_seconds=0,
+    sleeps = []
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        max_retries=max_retries,
+        sleep=sleeps.append,
     )
-    backend = GraphAPIMailBackend(
-        fail_silently=True,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+    assert backend.send_messages([example_message_ro] * 3) == expected_sent_count
+    assert sleeps == expected_sleeps
+    # only the throttled requests are sent again
+    assert len(mock_http_session.attempted_messages) == 3 + 2 * len(expected_sleeps)
+
+
+@pytest.mark.parametrize('mock_http_session', [
+    {'failed_batch_requests': 2, 'failed_batch_request_status': status}
+    for status in (500, 502, 504)
+], indirect=True)
+def test_send_messages_does_not_resend_batched_requests_failed_with_server_error(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    sleeps = []
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        sleep=sleeps.append,
     )
-    successfully_sent_count = backend.send_messages([example_message])
-    assert successfully_sent_count == 0
+    # Graph may have delivered them anyway
+    assert backend.send_messages([example_message_ro] * 3) == 1
+    assert sleeps == []
+    assert len(mock_http_session.attempted_messages) == 3
 
 
-def test_send_messages_tries_to_send_all_messages_when_fail_silently_on(
-    example_message: EmailMessage,
+@pytest.mark.parametrize('mock_http_session', [{'unanswered_batch_requests': 1}], indirect=True)
+def test_send_messages_logs_batched_requests_without_response(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+    caplog: pytest.LogCaptureFixture,
 ):
-    mock_http_session = MockSession(
-        raise_request_exception_on_sent_mail=True,
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
     )
-    backend = GraphAPIMailBackend(
-        fail_silently=True,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+    assert backend.send_messages([example_message_ro] * 3) == 2
+    assert 'Graph did not respond to it' in caplog.text
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_send_messages_sends_sendmail_a_base64_encoded_mime_message(
+    example_message_ro: EmailMessage,
+    batch_size: int,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        batch_size=batch_size,
     )
-    to_send = [example_message] * 3
-    backend.send_messages(to_send)
-    # the - 1 is there to account for token acqusition request
-    assert (mock_http_session.post_call_count - 1) == len(to_send)
+    backend.send_messages([example_message_ro] * 2)
+    for attempted_message in mock_http_session.attempted_messages:
+        mime_message = email.message_from_bytes(base64.b64decode(attempted_message, validate=True))
+        assert mime_message['Subject'] == example_message_ro.subject
 
 
-@pytest.mark.parametrize('expected_exception, fail_sent_mail, fail_token_refresh', [
-    (HTTPError, False, True),
-    (RequestException, True, False),
-])
-def test_send_messages_raises_exception_on_error_when_fail_silently_off(
-    expected_exception: type[Exception],
-    fail_sent_mail: bool,
-    fail_token_refresh: bool,
+@pytest.mark.parametrize('mock_http_session', [{'fail_batch': True}], indirect=True)
+def test_send_messages_logs_why_a_batch_failed(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+    caplog: pytest.LogCaptureFixture,
+):
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    assert backend.send_messages([example_message_ro] * 3) == 0
+    assert 'Failed to send a batch of 3 emails. Graph saying: Unauthorized (401)' in caplog.text
+    assert 'InvalidAuthenticationToken' in caplog.text
+
+
+def test_open_leaves_shared_session_headers_untouched(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    backend.open()
+    assert dict(mock_http_session.headers) == {'User-Agent': 'python-requests'}
+
+
+def test_backend_reusing_a_session_can_acquire_a_token(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    start = datetime(year=2002, month=7, day=22, hour=12, minute=00, second=00)
+    make_backend(
+        mock_http_session,
+        fail_silently=False,
+        get_now=lambda: start,
+    ).send_messages([example_message_ro])
+    # the cached token is about to expire, so another one is requested through the same session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        get_now=lambda: start + timedelta(seconds=mock_http_session.expires_in_seconds),
+    )
+    assert backend.send_messages([example_message_ro]) == 1
+
+
+def test_backends_with_different_secrets_use_different_sessions(
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    created_sessions = []
+    def create_session():
+        created_sessions.append(mock_http_session)
+        return mock_http_session
+
+    for client_secret in ('old-secret', 'rotated-secret'):
+        backend = GraphAPIMailBackend(
+            fail_silently=False,
+            **{**mock_http_session.credentials, 'client_secret': client_secret},
+            create_session=create_session,
+        )
+        backend.open()
+        backend.close()
+    assert len(created_sessions) == 2
+
+
+def test_sessions_are_not_reused_after_fork(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    created_sessions = []
+    def create_session():
+        created_sessions.append(mock_http_session)
+        return mock_http_session
+
+    for _ in range(2):
+        backend = GraphAPIMailBackend(
+            fail_silently=False,
+            **mock_http_session.credentials,
+            create_session=create_session,
+        )
+        backend.open()
+        backend.close()
+        # what os.register_at_fork runs in the child process
+        graph_api_mail_backend._forget_sessions_after_fork()
+    assert len(created_sessions) == 2
+
+
+@pytest.mark.parametrize('batch_size', [1, graph_api_mail_backend.MAX_BATCH_SIZE])
+def test_send_messages_serializes_each_email_once(
     example_message: EmailMessage,
+    batch_size: int,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    serialization_count = 0
+    message = example_message.message
+    def count_serializations():
+        nonlocal serialization_count
+        serialization_count += 1
+        return message()
+    example_message.message = count_serializations
+
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+        concurrency=1,
+        batch_size=batch_size,
+    )
+    assert backend.send_messages([example_message] * 3) == 3
+    assert serialization_count == 1
+
+
+def test_serialized_messages_keeps_only_messages_sent_again(
+    example_message_ro: EmailMessage,
+    make_email: MakeEmail,
+):
+    other_message = make_email()
+    serialized_messages = SerializedMessages([example_message_ro, other_message, example_message_ro])
+    first = serialized_messages.serialize(example_message_ro)
+    assert serialized_messages.serialize(example_message_ro) is first
+    # dropped after its last send
+    assert serialized_messages.serialize(example_message_ro) is not first
+    # sent once, so not kept at all
+    assert serialized_messages.serialize(other_message) is not serialized_messages.serialize(other_message)
+
+
+def test_backends_with_the_same_configuration_reuse_one_session(
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    created_sessions = []
+    def create_session():
+        created_sessions.append(mock_http_session)
+        return mock_http_session
+
+    for _ in range(2):
+        backend = GraphAPIMailBackend(
+            fail_silently=False,
+            **mock_http_session.credentials,
+            create_session=create_session,
+        )
+        backend.open()
+        backend.close()
+    assert len(created_sessions) == 1
+
+
+@pytest.mark.parametrize('emails_count', [1, 2])
+def test_send_messages_does_not_save_emails_to_sent_items_when_asked_not_to(
+    example_message_ro: EmailMessage,
+    emails_count: int,
+    make_backend: MakeBackend,
 ):
     mock_http_session = MockSession(
-        raise_request_exception_on_sent_mail=fail_sent_mail,
-        fail_token_refresh=fail_token_refresh,
-        # set so token is refreshed so to test case when refreshing token fails
-        expires_in_seconds=0,
+        allowed_from_mails={
+            graph_api_mail_backend.construct_send_email_endpoint(
+                example_message_ro.from_email,
+                save_to_sent_items=False,
+            ),
+        },
     )
-    backend = GraphAPIMailBackend(
+    backend = make_backend(
+        mock_http_session,
         fail_silently=False,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+        save_to_sent_items=False,
     )
-    with pytest.raises(expected_exception):
-        backend.send_messages([example_message])
+    assert backend.send_messages([example_message_ro] * emails_count) == emails_count
 
 
-def test_emails_without_recipients_are_not_sent(
-    example_message: EmailMessage,
+def test_send_messages_keeps_connection_opened_by_caller_open(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
 ):
-    example_message.to = [] 
-    example_message.cc = [] 
-    example_message.bcc = [] 
-    mock_http_session = MockSession()
-    backend = GraphAPIMailBackend(
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
         fail_silently=False,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
     )
-    sent_emails_count = backend.send_messages([example_message])
-    assert sent_emails_count == 0
+    with backend:
+        backend.send_messages([])
+        # still open, so no new connection is created
+        assert not backend.open()
+    # a single close() is enough, like with Django's own backends
+    assert backend.open()
 
 
-def test_email_is_extracted_from_from_email_in_name_form(
-    example_message: EmailMessage,
+def test_caller_closing_connection_stops_background_refresh(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
 ):
-    example_message.from_email = f'Fred <{example_message.from_email}>'
-    mock_http_session = MockSession()
-    backend = GraphAPIMailBackend(
+    mock_http_session = fresh_happy_session
+    start = datetime(year=2002, month=7, day=22, hour=12, minute=00, second=00)
+    time_moments = iter([start])
+    def get_now():
+        # past TOKEN_BACKGROUND_REFRESH_AT of the token's lifetime, so a refresh is started
+        return next(time_moments, start + timedelta(seconds=mock_http_session.expires_in_seconds * 0.9))
+
+    backend = make_backend(
+        mock_http_session,
         fail_silently=False,
-        client_id=mock_http_session.client_id,
-        client_secret=mock_http_session.client_secret,
-        tenant_id=mock_http_session.tenant_id,
-        create_session=lambda: mock_http_session,
+        concurrency=1,
+        get_now=get_now,
     )
-    backend.send_messages([example_message])
+    threads_count = threading.active_count()
+    # the pattern of Django's smtp backend, a connection that was already open stays open
+    new_conn_created = backend.open()
+    backend.send_messages([example_message_ro] * 2)
+    assert not backend.open()
+    if new_conn_created:
+        backend.close()
+    # the refresh was waited for and its thread stopped
+    assert mock_http_session.times_token_refreshed == 1
+    assert threading.active_count() == threads_count
+    # closed, so a new connection is opened
+    assert backend.open()
 
+
+def test_open_does_not_block_other_threads_while_acquiring_token(
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    blocked = []
+    def close_from_another_thread(url):
+        closing_thread = threading.Thread(target=backend.close)
+        closing_thread.start()
+        closing_thread.join(timeout=1)
+        blocked.append(closing_thread.is_alive())
+
+    mock_http_session.on_post = close_from_another_thread
+    assert backend.open()
+    assert blocked == [False]
+
+
+def test_connection_opened_while_sends_are_in_flight_stays_open(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    fresh_happy_session: MockSession,
+):
+    mock_http_session = fresh_happy_session
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    opened_while_sending = []
+    def open_while_sending(url):
+        if url != graph_api_mail_backend.construct_token_endpoint(mock_http_session.tenant_id):
+            opened_while_sending.append(backend.open())
+
+    mock_http_session.on_post = open_while_sending
+    assert backend.send_messages([example_message_ro]) == 1
+    mock_http_session.on_post = None
+    # the connection is the caller's to close now
+    assert opened_while_sending == [True]
+    assert not backend.open()
+    backend.close()
+    assert backend.open()
+
+
+# expires_in_seconds=0, so the token is refreshed by each send_messages call
+@pytest.mark.parametrize('mock_http_session', [{'expires_in_seconds': 0}], indirect=True)
+def test_one_backend_can_send_messages_from_many_threads(
+    example_message_ro: EmailMessage,
+    make_backend: MakeBackend,
+    mock_http_session: MockSession,
+):
+    backend = make_backend(
+        mock_http_session,
+        fail_silently=False,
+    )
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sent_emails_counts = list(executor.map(
+            backend.send_messages,
+            [[example_message_ro] * 2] * 16,
+        ))
+    assert sent_emails_counts == [2] * 16